@@ -1,23 +1,30 @@
 import asyncio
+import bisect
+import hashlib
 import httpx
-import json
+import orjson
 import random
 import os
 import re
 import logging
 import aiosqlite
-import requests
-import tempfile
-from bs4 import BeautifulSoup
-from faster_whisper import WhisperModel
+import io
+import numpy as np
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import lxml.html
+from lxml import etree
+import ctranslate2
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 from datetime import datetime
-from typing import Dict
+from typing import Dict, NamedTuple, Optional
 from zoneinfo import ZoneInfo
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import InlineQueryResultArticle, InputTextMessageContent, CallbackQuery
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 # Настройка логирования
@@ -26,41 +33,197 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
 DB_PATH = "mitya_data.db"
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://ollama:11434")
 
 if not TOKEN:
     exit("Ошибка: токен не найден!")
 
 bot = Bot(token=TOKEN)
 dp = Dispatcher()
+# Свой генератор для игр и реакций, независимый от глобального состояния random
+rng = random.Random()
 
 
 
 
 # --- WHISPER  ---
+# Имя модели или путь к заранее сконвертированной (ct2-transformers-converter --quantization int8)
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base")
+# Куда качать модель (по умолчанию кэш Hugging Face): в контейнере стоит держать на томе,
+# иначе модель скачивается заново после каждого пересоздания
+WHISPER_DOWNLOAD_ROOT = os.getenv("WHISPER_DOWNLOAD_ROOT")
+
+
+def pick_compute_type(device: str, preferred) -> str:
+    """Первый из preferred, который умеет текущее железо (CTranslate2 знает лучше нас)"""
+    try:
+        supported = ctranslate2.get_supported_compute_types(device)
+    except (RuntimeError, ValueError):
+        # Устройство недоступно — пусть WhisperModel сам скажет об этом при загрузке
+        return "default"
+    for compute_type in preferred:
+        if compute_type in supported:
+            return compute_type
+    return "default"
+
+
+# Есть CUDA — считаем на видеокарте в int8 с float16-активациями (или просто float16),
+# иначе на CPU в int8. int8_bfloat16 на CPU быстрее, но только с AVX512-BF16 — берём его, если есть.
+# WHISPER_DEVICE в окружении перекрывает автоопределение (например, отдать видеокарту Ollama).
+WHISPER_DEVICE = os.getenv("WHISPER_DEVICE") or ("cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu")
+if WHISPER_DEVICE == "cuda":
+    WHISPER_COMPUTE_TYPE = pick_compute_type(WHISPER_DEVICE, ("int8_float16", "float16"))
+else:
+    WHISPER_COMPUTE_TYPE = pick_compute_type(WHISPER_DEVICE, ("int8_bfloat16", "int8"))
+
+# Потоки CTranslate2 на CPU: по ядрам, реально доступным процессу (cpuset контейнера),
+# а не по всем ядрам хоста — иначе потоки толкаются за одни и те же ядра.
+# WHISPER_CPU_THREADS в окружении перекрывает (например, оставить ядро под Ollama).
+if os.getenv("WHISPER_CPU_THREADS"):
+    WHISPER_CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS"))
+elif hasattr(os, "sched_getaffinity"):
+    WHISPER_CPU_THREADS = len(os.sched_getaffinity(0))
+else:
+    WHISPER_CPU_THREADS = os.cpu_count() or 0
+
 try:
-    logging.info("Инициализация Faster-Whisper...")
-    whisper_model = WhisperModel("base", device="cpu", compute_type="int8")
+    logging.info(f"Инициализация Faster-Whisper {WHISPER_MODEL} ({WHISPER_DEVICE}, {WHISPER_COMPUTE_TYPE})...")
+    # Whisper крутится в одном рабочем потоке, так что все ядра CPU отдаём CTranslate2
+    whisper_model = WhisperModel(WHISPER_MODEL, device=WHISPER_DEVICE, compute_type=WHISPER_COMPUTE_TYPE,
+                                 cpu_threads=WHISPER_CPU_THREADS, download_root=WHISPER_DOWNLOAD_ROOT)
+    # Режет аудио по VAD на куски и прогоняет их через энкодер пачкой
+    batched_whisper = BatchedInferencePipeline(model=whisper_model)
     logging.info("Whisper загружен!")
 except Exception as e:
     logging.error(f"Ошибка загрузки Whisper: {e}")
     whisper_model = None
+    batched_whisper = None
+
+WHISPER_BATCH_SIZE = 8
+# Свой поток под Whisper: CTranslate2 сам раскидывает матрицы по ядрам,
+# а общий пул asyncio.to_thread не забивается многосекундными задачами
+_whisper_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisper")
+
+
+def _transcribe_sync(audio: io.BytesIO) -> str:
+    # transcribe возвращает ленивый генератор: вся работа идёт при обходе сегментов,
+    # поэтому обходим их тут же, в рабочем потоке
+    # В батч-режиме каждый кусок декодируется без оглядки на предыдущий
+    # (condition_on_previous_text=False внутри), VAD выкидывает тишину.
+    segments, info = batched_whisper.transcribe(
+        audio, beam_size=1, language="ru",
+        batch_size=WHISPER_BATCH_SIZE, vad_filter=True
+    )
+    # У сегментов Faster-Whisper пробел уже в начале текста — склеиваем как есть
+    return "".join(s.text for s in segments).strip()
+
+
+def _warm_up_whisper():
+    """Секунда тишины мимо VAD: первое настоящее голосовое не платит за холодный старт"""
+    try:
+        segments, info = whisper_model.transcribe(
+            np.zeros(16000, dtype=np.float32), beam_size=1, language="ru", vad_filter=False
+        )
+        for _ in segments:
+            pass
+    except Exception as e:
+        logging.warning(f"Прогрев Whisper не удался: {e}")
+
+
+# Расшифровки по file_unique_id: пересланное голосовое не гоняем через Whisper повторно
+VOICE_CACHE_SIZE = 512
+_voice_cache: "OrderedDict[str, str]" = OrderedDict()
+
+
+def get_cached_transcript(file_key: str) -> Optional[str]:
+    text = _voice_cache.get(file_key)
+    if text is not None:
+        _voice_cache.move_to_end(file_key)
+    return text
+
+
+def cache_transcript(file_key: str, text: str):
+    _voice_cache[file_key] = text
+    _voice_cache.move_to_end(file_key)
+    if len(_voice_cache) > VOICE_CACHE_SIZE:
+        _voice_cache.popitem(last=False)
+
+
+async def transcribe_voice(audio: io.BytesIO) -> str:
+    """Распознаёт голосовое в потоке Whisper; голосовые идут по одному в порядке прихода"""
+    return await asyncio.get_running_loop().run_in_executor(_whisper_pool, _transcribe_sync, audio)
 
 # --- Вспомогательные структуры ---
-_chat_locks: Dict[int, asyncio.Lock] = {}
+# Локи по чатам в LRU: давно молчащие чаты вытесняются, чтобы словарь не рос бесконечно
+CHAT_LOCKS_MAX = 4096
+_chat_locks: "OrderedDict[int, asyncio.Lock]" = OrderedDict()
 
 
 def get_chat_lock(chat_id: int) -> asyncio.Lock:
     lock = _chat_locks.get(chat_id)
-    if lock is None:
-        lock = asyncio.Lock()
-        _chat_locks[chat_id] = lock
+    if lock is not None:
+        _chat_locks.move_to_end(chat_id)
+        return lock
+
+    lock = asyncio.Lock()
+    _chat_locks[chat_id] = lock
+    if len(_chat_locks) > CHAT_LOCKS_MAX:
+        # Выкидываем самый старый свободный лок; занятые не трогаем
+        for old_chat_id, old_lock in _chat_locks.items():
+            if not old_lock.locked() and old_chat_id != chat_id:
+                del _chat_locks[old_chat_id]
+                break
     return lock
 
 
 
 # --- БАЗА ДАННЫХ ---
+# Одно соединение на всё время жизни бота (открывается в main)
+_db: Optional[aiosqlite.Connection] = None
+# SQLite допускает только одного писателя — пишем строго по очереди
+_db_write_lock = asyncio.Lock()
+
+
+async def open_db():
+    global _db
+    _db = await aiosqlite.connect(DB_PATH)
+    await _db.execute("PRAGMA journal_mode=WAL")
+    await _db.execute("PRAGMA synchronous=NORMAL")
+    await _db.execute("PRAGMA temp_store=MEMORY")
+    await _db.execute("PRAGMA cache_size=-64000")
+    # Читаем страницы через mmap (до 256 МБ) — меньше копирований в read()
+    await _db.execute("PRAGMA mmap_size=268435456")
+    # Освежаем статистику планировщика, если таблицы заметно выросли (обычно no-op)
+    await _db.execute("PRAGMA optimize=0x10002")
+
+
+def get_db() -> aiosqlite.Connection:
+    if _db is None:
+        raise RuntimeError("База не открыта: сначала вызови open_db()")
+    return _db
+
+
+async def close_db():
+    global _db
+    if _db is not None:
+        # Докидываем планировщику статистику по запросам этой сессии
+        await _db.execute("PRAGMA optimize")
+        await _db.close()
+        _db = None
+
+
+# Версия схемы хранится в PRAGMA user_version; поднимай при каждой миграции
+SCHEMA_VERSION = 1
+
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    db = get_db()
+    async with db.execute("PRAGMA user_version") as cursor:
+        version = (await cursor.fetchone())[0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    async with _db_write_lock:
         # Таблица для стикеров
         await db.execute('''
             CREATE TABLE IF NOT EXISTS collected_stickers (
@@ -69,9 +232,7 @@ async def init_db():
                 sentiment TEXT
             )
         ''')
-        await db.commit()
 
-    async with aiosqlite.connect(DB_PATH) as db:
         # Основная таблица
         await db.execute('''
             CREATE TABLE IF NOT EXISTS chats (
@@ -83,11 +244,11 @@ async def init_db():
         ''')
 
         # Миграция: Проверяем, есть ли колонка reply_chance (для старых баз)
-        try:
+        async with db.execute("PRAGMA table_info(chats)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        if "reply_chance" not in columns:
             await db.execute("ALTER TABLE chats ADD COLUMN reply_chance INTEGER DEFAULT 0")
             logging.info("База обновлена: добавлена колонка reply_chance")
-        except Exception:
-            pass  # Колонка уже есть или ALTER не поддерживается
 
         # Репутация
         await db.execute('''
@@ -112,12 +273,40 @@ async def init_db():
         ''')
 
         # Индексы для скорости
+        # idx_messages_chat_id неявно содержит rowid (= id), т.е. это уже индекс (chat_id, id)
         await db.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id)')
         await db.execute('CREATE INDEX IF NOT EXISTS idx_users_chat_user ON users(chat_id, user_id)')
+        # Схема поменялась — пересобираем статистику для планировщика
+        await db.execute("ANALYZE")
 
+        await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         await db.commit()
 
 
+# DuckDuckGo: парсим lxml (C) вместо html.parser, XPath компилируем один раз
+_HTML_PARSER = lxml.html.HTMLParser()
+_DDG_RESULTS_XPATH = etree.XPath(
+    "//div[contains(concat(' ', normalize-space(@class), ' '), ' result ')]"
+)
+_DDG_SNIPPET_XPATH = etree.XPath(
+    ".//a[contains(concat(' ', normalize-space(@class), ' '), ' result__snippet ')]"
+)
+_WS_RE = re.compile(r'\s+')
+
+
+def _parse_ddg_snippets(html: str, limit: int = 3):
+    tree = lxml.html.fromstring(html, parser=_HTML_PARSER)
+    results = []
+    for result in _DDG_RESULTS_XPATH(tree):
+        snippet_tags = _DDG_SNIPPET_XPATH(result)
+        if snippet_tags:
+            text = "".join(snippet_tags[0].itertext())
+            results.append(_WS_RE.sub(' ', text).strip())
+            if len(results) >= limit:
+                break
+    return results
+
+
 async def mit_info_search(query: str):
     """Парсинг DuckDuckGo HTML для Mit Info"""
     url = "https://html.duckduckgo.com/html/"
@@ -127,83 +316,191 @@ async def mit_info_search(query: str):
         "Referer": "https://duckduckgo.com/"
     }
     try:
-        # Используем httpx, так как он уже есть в твоем проекте
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(url, data=payload, headers=headers)
-            if response.status_code != 200:
-                return None
-
-            soup = BeautifulSoup(response.text, 'html.parser')
-            results = []
-            for result in soup.find_all('div', class_='result'):
-                snippet_tag = result.find('a', class_='result__snippet')
-                if snippet_tag:
-                    text = snippet_tag.get_text(strip=True)
-                    results.append(re.sub(r'\s+', ' ', text))
-
-            return "\n\n".join(results[:3]) if results else None
+        # Общий клиент _ext_client держит соединение с DuckDuckGo живым между запросами
+        response = await _ext_client.post(url, data=payload, headers=headers)
+        if response.status_code != 200:
+            return None
+
+        # Разбор HTML — чистый CPU, уводим его с event loop
+        results = await asyncio.to_thread(_parse_ddg_snippets, response.text)
+
+        return "\n\n".join(results) if results else None
     except Exception as e:
         logging.error(f"Search error: {e}")
         return None
 
+# Кэш настроек чатов: читаются на каждое сообщение, меняются редко
+_settings_cache: Dict[int, dict] = {}
+
+
 async def get_chat_settings(chat_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        try:
-            async with db.execute(
-                "SELECT ai_enabled, voice_enabled, reply_chance FROM chats WHERE chat_id = ?",
-                (chat_id,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return {"ai_enabled": row[0], "voice_enabled": row[1], "reply_chance": row[2]}
-        except Exception as e:
-            logging.exception(f"Ошибка чтения настроек: {e}")
+    cached = _settings_cache.get(chat_id)
+    if cached is not None:
+        return cached
 
-        # Если чата нет или ошибка -> создаем дефолт
-        try:
+    db = get_db()
+    try:
+        async with db.execute(
+            "SELECT ai_enabled, voice_enabled, reply_chance FROM chats WHERE chat_id = ?",
+            (chat_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                settings = {"ai_enabled": row[0], "voice_enabled": row[1], "reply_chance": row[2]}
+                _settings_cache[chat_id] = settings
+                return settings
+    except Exception as e:
+        logging.exception(f"Ошибка чтения настроек: {e}")
+
+    # Если чата нет или ошибка -> создаем дефолт
+    try:
+        async with _db_write_lock:
             await db.execute(
                 "INSERT OR IGNORE INTO chats (chat_id, ai_enabled, voice_enabled, reply_chance) VALUES (?, 1, 1, 0)",
                 (chat_id,)
             )
             await db.commit()
-        except Exception:
-            logging.exception("Ошибка при создании дефолтных настроек чата")
+        _settings_cache[chat_id] = {"ai_enabled": 1, "voice_enabled": 1, "reply_chance": 0}
+    except Exception:
+        logging.exception("Ошибка при создании дефолтных настроек чата")
 
-        return {"ai_enabled": 1, "voice_enabled": 1, "reply_chance": 0}
+    return {"ai_enabled": 1, "voice_enabled": 1, "reply_chance": 0}
+
+
+# Готовые UPDATE на каждую разрешённую колонку — заодно это белый список
+_UPDATE_SETTING_SQL = {
+    column: f"UPDATE chats SET {column} = ? WHERE chat_id = ?"
+    for column in ("ai_enabled", "voice_enabled", "reply_chance")
+}
 
 
 async def update_setting(chat_id, column, value):
-    allowed_columns = ["ai_enabled", "voice_enabled", "reply_chance"]
-    if column not in allowed_columns:
+    sql = _UPDATE_SETTING_SQL.get(column)
+    if sql is None:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(f"UPDATE chats SET {column} = ? WHERE chat_id = ?", (value, chat_id))
+    db = get_db()
+    async with _db_write_lock:
+        await db.execute(sql, (value, chat_id))
         await db.commit()
 
+    cached = _settings_cache.get(chat_id)
+    if cached is not None:
+        cached[column] = value
+
+
+# Кэш репутации (chat_id, user_id) -> очки; меняется только при записи кармы в базу.
+# LRU: запись появляется у каждого, чьё сообщение оценили, — давно молчащие вытесняются
+REP_CACHE_SIZE = 8192
+_rep_cache: "OrderedDict[tuple, int]" = OrderedDict()
+
+
+def cache_reputation(chat_id, user_id, rep: int):
+    key = (chat_id, user_id)
+    _rep_cache[key] = rep
+    _rep_cache.move_to_end(key)
+    if len(_rep_cache) > REP_CACHE_SIZE:
+        _rep_cache.popitem(last=False)
+
+
+# Карму пишем не из хендлера, а пачками раз в REP_FLUSH_INTERVAL одной транзакцией:
+# один commit (и fsync WAL) на всю пачку вместо commit на каждое сообщение
+REP_FLUSH_INTERVAL = 0.1
+_rep_queue: asyncio.Queue = asyncio.Queue()
+
+# WHERE в DO UPDATE: если упёрлись в потолок ±150 и имя то же —
+# строку не переписываем вовсе (ни грязной страницы, ни записи в WAL)
+_UPSERT_REPUTATION_SQL = '''
+    INSERT INTO users (user_id, chat_id, first_name, reputation)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, chat_id) DO UPDATE SET 
+    reputation = MAX(-150, MIN(150, reputation + excluded.reputation)),
+    first_name = excluded.first_name
+    WHERE reputation != MAX(-150, MIN(150, reputation + excluded.reputation))
+       OR first_name IS NOT excluded.first_name
+    RETURNING reputation
+'''
+
+
+def update_reputation(chat_id, user_id, name, change):
+    """Ставит изменение кармы в очередь; запишет его reputation_flusher"""
+    _rep_queue.put_nowait((user_id, chat_id, name, change))
 
-async def update_reputation(chat_id, user_id, name, change):
-    async with aiosqlite.connect(DB_PATH) as db:
+
+async def _write_reputation_batch(batch):
+    """Пишет пачку одной транзакцией. Не бросает исключений — иначе умрёт reputation_flusher"""
+    db = get_db()
+    # Откат — под тем же локом: соединение общее, чужие запросы в откат попасть не должны
+    async with _db_write_lock:
         try:
-            await db.execute('''
-                INSERT INTO users (user_id, chat_id, first_name, reputation)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(user_id, chat_id) DO UPDATE SET 
-                reputation = MAX(-150, MIN(150, reputation + ?)),
-                first_name = ?
-            ''', (user_id, chat_id, name, change, change, name))
+            # Изменения применяем по порядку: потолок ±150 считается после каждого
+            for params in batch:
+                async with db.execute(_UPSERT_REPUTATION_SQL, params) as cursor:
+                    row = await cursor.fetchone()
+                if row:
+                    cache_reputation(params[1], params[0], row[0])
             await db.commit()
         except Exception:
             logging.exception("Ошибка при обновлении репутации")
+            for user_id, chat_id, _, _ in batch:
+                _rep_cache.pop((chat_id, user_id), None)
+            try:
+                await db.rollback()
+            except Exception:
+                logging.exception("Не удалось откатить транзакцию репутации")
+
+
+async def reputation_flusher():
+    """Фоновая задача: копит изменения кармы и пишет их пачкой. None в очереди — стоп"""
+    while True:
+        item = await _rep_queue.get()
+        if item is None:
+            return
+        await asyncio.sleep(REP_FLUSH_INTERVAL)
+        batch = [item]
+        stop = False
+        while not _rep_queue.empty():
+            item = _rep_queue.get_nowait()
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        await _write_reputation_batch(batch)
+        if stop:
+            return
 
 
 async def get_user_reputation(chat_id, user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT reputation FROM users WHERE user_id = ? AND chat_id = ?",
-            (user_id, chat_id)
-        ) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else 0
+    cached = _rep_cache.get((chat_id, user_id))
+    if cached is not None:
+        _rep_cache.move_to_end((chat_id, user_id))
+        return cached
+
+    db = get_db()
+    async with db.execute(
+        "SELECT reputation FROM users WHERE user_id = ? AND chat_id = ?",
+        (user_id, chat_id)
+    ) as cursor:
+        row = await cursor.fetchone()
+    rep = row[0] if row else 0
+    cache_reputation(chat_id, user_id, rep)
+    return rep
+
+
+# Чистим старую историю не на каждую запись, а раз в CONTEXT_TRIM_EVERY сообщений.
+# Счётчики по чатам — в LRU, как и локи: давно молчащие чаты вытесняются
+# (счёт для них просто начнётся заново)
+CONTEXT_TRIM_EVERY = 10
+SAVE_COUNTER_MAX = 4096
+_save_counter: "OrderedDict[int, int]" = OrderedDict()
+
+
+def _bump_save_counter(chat_id: int) -> int:
+    count = _save_counter.get(chat_id, 0) + 1
+    _save_counter[chat_id] = count
+    _save_counter.move_to_end(chat_id)
+    if len(_save_counter) > SAVE_COUNTER_MAX:
+        _save_counter.popitem(last=False)
+    return count
 
 
 async def save_context(chat_id, role, content, user_name=None):
@@ -211,97 +508,224 @@ async def save_context(chat_id, role, content, user_name=None):
     if role == "user" and user_name:
         final_content = f"От пользователя {user_name}: {content}"
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    db = get_db()
+    async with _db_write_lock:
         await db.execute(
             "INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)",
             (chat_id, role, final_content)
         )
-        await db.execute('''
-            DELETE FROM messages
-            WHERE chat_id = ?
-              AND id NOT IN (
-                SELECT id FROM messages
+        if _bump_save_counter(chat_id) % CONTEXT_TRIM_EVERY == 0:
+            # id растёт монотонно (AUTOINCREMENT), так что "последние 20" — это окно по id:
+            # и подзапрос, и удаление идут по индексу (chat_id, id) без сортировки
+            await db.execute('''
+                DELETE FROM messages
                 WHERE chat_id = ?
-                ORDER BY timestamp DESC
-                LIMIT 20
-              )
-        ''', (chat_id, chat_id))
+                  AND id <= (
+                    SELECT id FROM messages
+                    WHERE chat_id = ?
+                    ORDER BY id DESC
+                    LIMIT 1 OFFSET 20
+                  )
+            ''', (chat_id, chat_id))
         await db.commit()
 
 
+# Бюджет истории для Ollama в символах (≈500 токенов кириллицы): на CPU время
+# ответа Gemma растёт вместе с длиной промпта, а не с числом сообщений
+CONTEXT_CHAR_BUDGET = 2000
+
+
 async def get_context(chat_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('''
-            SELECT role, content FROM messages 
-            WHERE chat_id = ? 
-            ORDER BY timestamp ASC LIMIT 15
-        ''', (chat_id,)) as cursor:
-            rows = await cursor.fetchall()
-            return [{"role": r[0], "content": r[1]} for r in rows]
+    db = get_db()
+    # Берём 15 последних (история может быть длиннее 20 до очередной чистки)
+    async with db.execute('''
+        SELECT role, content FROM messages
+        WHERE chat_id = ?
+        ORDER BY id DESC LIMIT 15
+    ''', (chat_id,)) as cursor:
+        rows = await cursor.fetchall()
+
+    # Идём от свежих к старым, пока влезаем в бюджет; подряд идущие реплики
+    # одной роли склеиваем в одно сообщение
+    history = []
+    budget = CONTEXT_CHAR_BUDGET
+    for role, content in rows:
+        if history and len(content) > budget:
+            break
+        budget -= len(content)
+        if history and history[-1]["role"] == role:
+            history[-1]["content"] = f"{content}\n{history[-1]['content']}"
+        else:
+            history.append({"role": role, "content": content})
+    history.reverse()
+    return history
+
+
+# Стикеры целиком в памяти: таблица пополняется только из catch_stickers_handler,
+# так что выбор случайного стикера — просто rng.choice по списку, без похода в БД
+_stickers_by_sentiment: Dict[str, list] = defaultdict(list)
+_all_stickers: list = []
+
+
+async def load_sticker_cache():
+    db = get_db()
+    async with db.execute("SELECT file_id, sentiment FROM collected_stickers") as cursor:
+        rows = await cursor.fetchall()
+    _stickers_by_sentiment.clear()
+    _all_stickers.clear()
+    for file_id, sentiment in rows:
+        remember_sticker(file_id, sentiment)
+
+
+def remember_sticker(file_id: str, sentiment: str):
+    _stickers_by_sentiment[sentiment].append(file_id)
+    _all_stickers.append(file_id)
+
+
+def get_random_sticker(sentiment: Optional[str] = None) -> Optional[str]:
+    """Случайный file_id стикера (по настроению, если задано) или None, если таких нет"""
+    pool = _all_stickers if sentiment is None else _stickers_by_sentiment.get(sentiment)
+    return rng.choice(pool) if pool else None
 
 
 # --- ФУНКЦИИ КОНТЕНТА ---
-def get_joke():
+# Общий клиент для внешних сайтов (шутки, предсказания)
+_ext_client = httpx.AsyncClient(
+    timeout=10.0,
+    headers={
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    },
+)
+
+
+async def get_joke():
     url = "https://randstuff.ru/joke/generate/"
     headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
         "Accept": "application/json, text/javascript, */*; q=0.01",
         "X-Requested-With": "XMLHttpRequest",
         "Origin": "https://randstuff.ru",
         "Referer": "https://randstuff.ru/joke/",
     }
-    session = requests.Session()
-    response = session.post(url, headers=headers, timeout=10)
+    response = await _ext_client.post(url, headers=headers)
     response.raise_for_status()
-    data = response.json()
+    data = orjson.loads(response.content)
     return data.get("joke", {}).get("text", "Шуток нет")
 
 
-def get_cookies():
+COOKIES_UNAVAILABLE = "Цитата недоступна"
+
+
+async def get_cookies():
     url = "https://api.forismatic.com/api/1.0/?method=getQuote&format=json&lang=ru"
     try:
-        resp = requests.get(url, timeout=5)
+        resp = await _ext_client.get(url, timeout=5.0)
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
         return data.get("quoteText", "Цитата пустая") # Добавлен return
-    except Exception:
+    except (httpx.HTTPError, ValueError, AttributeError):
+        # сеть, битый JSON или JSON не-объект (data.get) — как в _get_joke_or_none
         logging.exception("Ошибка get_cookies")
-        return "Цитата недоступна"
+        return COOKIES_UNAVAILABLE
 
 
-def get_random_quote():
+def _load_json(filename, default):
+    """Читает JSON рядом с bot.py один раз при старте"""
     try:
-        base_path = os.path.dirname(__file__)
-        file_path = os.path.join(base_path, 'quotes_Statham.json')
-        with open(file_path, 'r', encoding='utf-8') as f:
-            quotes = json.load(f)
-            quote_data = random.choice(quotes)
-            return quote_data.get('text', "Текст не найден") if isinstance(quote_data, dict) else str(quote_data)
+        file_path = os.path.join(os.path.dirname(__file__), filename)
+        with open(file_path, 'rb') as f:
+            return orjson.loads(f.read())
     except Exception:
-        logging.exception("Ошибка чтения цитат")
+        logging.exception(f"Ошибка чтения {filename}")
+        return default
+
+
+# Цитаты сразу сводим к готовым строкам — в хендлере остаётся один rng.choice
+_QUOTES = tuple(
+    q.get('text', "Текст не найден") if isinstance(q, dict) else str(q)
+    for q in _load_json('quotes_Statham.json', [])
+)
+# Поздравления сразу собираем по дате "MM-DD" (при совпадении дат берём первый)
+_HOLIDAY_TEXT_BY_DATE = {}
+for _holiday in _load_json('holidays.json', {}).get('holidays', []):
+    _HOLIDAY_TEXT_BY_DATE.setdefault(
+        _holiday.get('date'),
+        f"🎉 {_holiday.get('name')}!\n{_holiday.get('greeting')}"
+    )
+
+
+def get_random_quote():
+    if not _QUOTES:
         return "Цитаты временно закончились..."
+    return rng.choice(_QUOTES)
+
+
+MOSCOW_TZ = ZoneInfo("Europe/Moscow")
+# (дата, поздравление) на текущие сутки — пересчитываем только при смене дня
+_holiday_today = (None, None)
 
 
 def get_today_holiday():
-    try:
-        base_path = os.path.dirname(__file__)
-        file_path = os.path.join(base_path, 'holidays.json')
-        today_date = datetime.now(ZoneInfo("Europe/Moscow")).strftime("%m-%d")
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            holidays = data.get('holidays', [])
-            for holiday in holidays:
-                if holiday.get('date') == today_date:
-                    return f"🎉 {holiday.get('name')}!\n{holiday.get('greeting')}"
-        return None
-    except Exception:
-        logging.exception("Ошибка парсинга праздников")
-        return None
+    global _holiday_today
+    today = datetime.now(MOSCOW_TZ).date()
+    if _holiday_today[0] != today:
+        _holiday_today = (today, _HOLIDAY_TEXT_BY_DATE.get(today.strftime("%m-%d")))
+    return _holiday_today[1]
 
 
 # --- МОЗГИ (LLM) ---
+# Один клиент на всё время жизни бота: keep-alive соединения к Ollama
+_ollama = httpx.AsyncClient(
+    base_url=OLLAMA_HOST,
+    timeout=httpx.Timeout(30.0, connect=3.0),
+    limits=httpx.Limits(max_keepalive_connections=20),
+    headers={"Content-Type": "application/json"},
+)
+
+
+_NUM_RE = re.compile(r'-?\d+')
+# Оценки, которые прямо сейчас считаются: одинаковые сообщения ("+", "ахах", "ору"),
+# пришедшие пачкой, ждут один и тот же запрос к Ollama вместо очереди из дублей
+_toxicity_inflight: Dict[str, asyncio.Task] = {}
+# Готовые оценки (модель с temperature=0 детерминирована). Ключ — 16-байтный хэш текста,
+# чтобы длинные сообщения не раздували кэш
+TOXICITY_CACHE_SIZE = 4096
+_toxicity_cache: "OrderedDict[bytes, int]" = OrderedDict()
+
+
+def _toxicity_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+# Только цифры, пробелы и знаки препинания (ASCII и русская типографика). Эмодзи сюда
+# не входят: "🖕" или "❤️" — это как раз явная оценка, её ставит модель
+_PUNCT_DIGITS_RE = re.compile(r'[\d\s!-/:-@\[-`{-~«»„“”‘’—–…№]*')
+
+
+def is_trivially_neutral(text: str) -> bool:
+    """Сообщения, в которых оценивать нечего: "+", "))", "???", "100500" — сразу 0 без Ollama"""
+    return _PUNCT_DIGITS_RE.fullmatch(text) is not None
+
+
 async def check_toxicity_llm(text: str) -> int:
-    url = "http://ollama:11434/api/generate"
+    if is_trivially_neutral(text):
+        return 0
+
+    key = _toxicity_key(text)
+    score = _toxicity_cache.get(key)
+    if score is not None:
+        _toxicity_cache.move_to_end(key)
+        return score
+
+    task = _toxicity_inflight.get(text)
+    if task is None:
+        task = asyncio.create_task(_score_toxicity_llm(text))
+        _toxicity_inflight[text] = task
+        task.add_done_callback(lambda _: _toxicity_inflight.pop(text, None))
+    # shield: отмена одного из ждущих не должна отменять запрос для остальных
+    return await asyncio.shield(task)
+
+
+async def _score_toxicity_llm(text: str) -> int:
     prompt = (
         f"Instruction: Rate the message sentiment from -5 to +5.\n"
         f"0: Neutral, Questions, Facts, or SHORT/UNCLEAR fragments (e.g., single words, typos, abbreviations).\n"
@@ -314,25 +738,28 @@ async def check_toxicity_llm(text: str) -> int:
     )
 
     try:
-        async with httpx.AsyncClient(timeout=7.0) as client:
-            response = await client.post(url, json={
-                "model": "mitya-gemma",
-                "prompt": prompt,
-                "stream": False,
-                "options": {"num_predict": 3, "temperature": 0.0 }
-            })
-            resp_json = response.json()
-            raw_result = (resp_json.get("response") or "").strip()
-
-            # Ищем первое число в ответе (модель может написать "Оценка: -5")
-            match = re.search(r'-?\d+', raw_result)
-            if match:
-                return max(-5, min(5, int(match.group())))
-            return 0
+        response = await _ollama.post("/api/generate", content=orjson.dumps({
+            "model": "mitya-gemma",
+            "prompt": prompt,
+            "stream": False,
+            "options": {"num_predict": 3, "temperature": 0.0 }
+        }), timeout=7.0)
+        resp_json = orjson.loads(response.content)
+        raw_result = (resp_json.get("response") or "").strip()
+
+        # Ищем первое число в ответе (модель может написать "Оценка: -5")
+        match = _NUM_RE.search(raw_result)
+        score = max(-5, min(5, int(match.group()))) if match else 0
     except Exception as e:
             logging.error(f"Ошибка в check_toxicity_llm: {e}")
             return 0
 
+    # Кэшируем только настоящий ответ модели, а не заглушку после ошибки
+    _toxicity_cache[_toxicity_key(text)] = score
+    if len(_toxicity_cache) > TOXICITY_CACHE_SIZE:
+        _toxicity_cache.popitem(last=False)
+    return score
+
 
 REP_ADVICE = [
     (120, "Собеседник — Легенда Двора, твой старший брат. Впрягайся за него в любой кипиш, проявляй максимальное уважение и преданность."),
@@ -350,6 +777,23 @@ REP_ADVICE = [
 ]
 
 
+def _threshold_index(thresholds):
+    """Готовит пороги (по убыванию) для bisect: отрицаем, чтобы шли по возрастанию"""
+    return [-threshold for threshold, _ in thresholds], [text for _, text in thresholds]
+
+
+def pick_by_threshold(index, value, default):
+    """Текст первого порога, который value достигает (value >= threshold), иначе default"""
+    neg_thresholds, texts = index
+    i = bisect.bisect_left(neg_thresholds, -value)
+    return texts[i] if i < len(texts) else default
+
+
+_REP_ADVICE_INDEX = _threshold_index(REP_ADVICE)
+
+SPECIAL_AI_FALLBACK = "Чето не придумывается ниче, брат..."
+
+
 async def ask_mitya_special(prompt, system_instruction):
     """
     Универсальная функция для разовых задач (анекдоты, дополнение текста).
@@ -368,35 +812,55 @@ async def ask_mitya_special(prompt, system_instruction):
         }
     }
     try:
-        async with httpx.AsyncClient(timeout=20.0) as client:
-            response = await client.post("http://ollama:11434/api/chat", json=payload)
-            response.raise_for_status()
-            return response.json()['message']['content'].strip()
+        response = await _ollama.post("/api/chat", content=orjson.dumps(payload), timeout=20.0)
+        response.raise_for_status()
+        return orjson.loads(response.content)['message']['content'].strip()
     except Exception as e:
         logging.error(f"Ошибка в special_ai: {e}")
-        return "Чето не придумывается ниче, брат..."
+        return SPECIAL_AI_FALLBACK
+
+async def _stream_ollama_chat(payload: dict, on_update) -> str:
+    """Читает ответ /api/chat по кусочкам и отдаёт накопленный текст в on_update"""
+    reply = ""
+    body = orjson.dumps({**payload, "stream": True})
+    async with _ollama.stream("POST", "/api/chat", content=body, timeout=140.0) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            chunk = orjson.loads(line)
+            reply += (chunk.get("message") or {}).get("content", "")
+            if reply.strip():
+                await on_update(reply.strip())
+            if chunk.get("done"):
+                break
+    return reply
+
 
 async def ask_mitya_ai(chat_id: int, user_text: str, user_id: int = None,
-                     user_name: str = "Пацан", reply_to_text: str = None, is_auto: bool = False):
+                     user_name: str = "Пацан", reply_to_text: str = None, is_auto: bool = False,
+                     on_update=None):
+    """
+    Ответ Мити с учётом истории и репутации.
+    Если передан on_update, ответ стримится и on_update получает текст по мере генерации.
+    """
     # 1. Сохраняем с именем
     await save_context(chat_id, "user", user_text, user_name)
 
-    # 2. Получаем историю
-    history = await get_context(chat_id)
-
-    rep = 0
+    # 2. Получаем историю и репутацию (независимые чтения — одновременно)
     if user_id is not None:
-        rep = await get_user_reputation(chat_id, user_id)
+        history, rep = await asyncio.gather(
+            get_context(chat_id),
+            get_user_reputation(chat_id, user_id)
+        )
+    else:
+        history, rep = await get_context(chat_id), 0
 
     if reply_to_text:
         history.append({"role": "assistant", "content": reply_to_text})
 
 
-    extra_info = "Относись нейтрально."
-    for threshold, text in REP_ADVICE:
-        if rep >= threshold:
-            extra_info = text
-            break
+    extra_info = pick_by_threshold(_REP_ADVICE_INDEX, rep, "Относись нейтрально.")
 
     # --- СИСТЕМНЫЙ ПРОМПТ (Оптимизирован для Gemma 1b) ---
     base_prompt = (
@@ -409,16 +873,6 @@ async def ask_mitya_ai(chat_id: int, user_text: str, user_id: int = None,
     )
 
 
-    try:
-        if user_id is not None:
-            rep = await get_user_reputation(chat_id, user_id)
-            for threshold, text in REP_ADVICE:
-                if rep >= threshold:
-                    extra_info = text
-                    break
-    except Exception:
-        pass
-
     if is_auto:
         extra_info += " Ты сам влез в разговор без спроса. Будь краток и остроумен."
 
@@ -442,10 +896,12 @@ async def ask_mitya_ai(chat_id: int, user_text: str, user_id: int = None,
     lock = get_chat_lock(chat_id)
     async with lock:
         try:
-            async with httpx.AsyncClient(timeout=140.0) as client:
-                response = await client.post("http://ollama:11434/api/chat", json=payload)
+            if on_update is not None:
+                reply = (await _stream_ollama_chat(payload, on_update)).strip()
+            else:
+                response = await _ollama.post("/api/chat", content=orjson.dumps(payload), timeout=140.0)
                 response.raise_for_status()
-                resp_json = response.json()
+                resp_json = orjson.loads(response.content)
                 logging.debug(f"Ollama chat response: {resp_json}")
 
                 # Ollama может возвращать разный формат: "message": {"content": "..." } или "response": "..."
@@ -457,9 +913,9 @@ async def ask_mitya_ai(chat_id: int, user_text: str, user_id: int = None,
                     )
                 reply = (reply or "").strip()
 
-                if reply:
-                    await save_context(chat_id, "assistant", reply)
-                    return reply
+            if reply:
+                await save_context(chat_id, "assistant", reply)
+                return reply
         except Exception:
             logging.exception("AI Error в ask_mitya_ai")
 
@@ -467,26 +923,153 @@ async def ask_mitya_ai(chat_id: int, user_text: str, user_id: int = None,
 
 
 # --- МИДЛВЭР / УТИЛИТЫ ДЛЯ ХЕНДЛЕРОВ ---
-def extract_sender_info(message: types.Message):
+# Компилируем один раз, а не на каждое сообщение
+_MITYA_RE = re.compile(r'\bмитя\b', re.IGNORECASE)
+# Упоминание где угодно в тексте (как "митя" in text.lower()), но без копии текста в нижнем регистре
+_MITYA_MENTION_RE = re.compile(r'митя', re.IGNORECASE)
+
+# Telegram не любит частые правки одного сообщения — не чаще раза в секунду
+STREAM_EDIT_INTERVAL = 1.0
+
+
+class LiveReply:
+    """Сообщение, которое появляется с первыми словами ответа и дописывается правками."""
+
+    def __init__(self, message: types.Message, as_reply: bool = True):
+        self.message = message
+        self.as_reply = as_reply
+        self.sent = None
+        self.failed = False
+        self.text = ""
+        self.last_edit = 0.0
+
+    async def _send(self, text: str):
+        if self.as_reply:
+            self.sent = await self.message.reply(text)
+        else:
+            self.sent = await self.message.answer(text)
+        self.text = text
+        self.last_edit = asyncio.get_running_loop().time()
+
+    async def _edit(self, text: str):
+        try:
+            await self.sent.edit_text(text)
+        except TelegramBadRequest as e:
+            # Текст не поменялся — править нечего; остальное разбирают вызывающие
+            if "message is not modified" not in str(e):
+                raise
+        self.text = text
+        self.last_edit = asyncio.get_running_loop().time()
+
+    async def update(self, text: str):
+        if self.failed:
+            return
+        try:
+            if self.sent is None:
+                await self._send(text)
+            elif asyncio.get_running_loop().time() - self.last_edit >= STREAM_EDIT_INTERVAL:
+                await self._edit(text)
+        except Exception as e:
+            # Ошибку отправки разберёт finish(), а генерацию ответа не прерываем
+            logging.debug(f"Стрим ответа прерван: {e}")
+            self.failed = True
+
+    async def finish(self, text: str):
+        """Финальный текст: ошибки, кроме разобранных тут, уходят в обработку хендлера"""
+        if self.sent is None:
+            await self._send(text)
+            return
+        if text == self.text:
+            return
+        try:
+            await self._edit(text)
+        except TelegramRetryAfter as e:
+            # Флуд-контроль на правках: ждём, сколько просит Telegram, и правим ещё раз
+            await asyncio.sleep(e.retry_after)
+            await self._edit(text)
+        except TelegramBadRequest as e:
+            # Сообщение удалили или его уже нельзя править — шлём ответ заново целиком
+            logging.warning(f"Не удалось дописать ответ правкой, отправляю заново: {e}")
+            await self._send(text)
+
+
+class SenderInfo(NamedTuple):
+    user_id: Optional[int]
+    name: str
+    is_bot: bool
+    username: Optional[str]
+
+
+def extract_sender_info(message: types.Message) -> SenderInfo:
     """Возвращает безопасно (user_id, name, is_bot, username) учитывая sender_chat."""
-    from_user = getattr(message, "from_user", None)
+    from_user = message.from_user
     if from_user:
-        user_id = getattr(from_user, "id", None)
-        name = getattr(from_user, "first_name", None) or "User"
-        is_bot = bool(getattr(from_user, "is_bot", False))
-        username = getattr(from_user, "username", None)
-    else:
-        # сообщение от sender_chat (канал)
-        sender_chat = getattr(message, "sender_chat", None)
-        user_id = getattr(sender_chat, "id", None)
-        name = getattr(sender_chat, "title", "SenderChat")
-        is_bot = False
-        username = getattr(sender_chat, "username", None)
-    return user_id, name, is_bot, username
+        return SenderInfo(from_user.id, from_user.first_name or "User", bool(from_user.is_bot), from_user.username)
+    # сообщение от sender_chat (канал)
+    sender_chat = message.sender_chat
+    if sender_chat:
+        return SenderInfo(sender_chat.id, sender_chat.title, False, sender_chat.username)
+    return SenderInfo(None, "SenderChat", False, None)
 
 
 # --- ИНЛАЙН И ТЕКСТОВЫЕ ИГРЫ (ОСТАЛИСЬ БЕЗ ИЗМЕНЕНИЙ) ---
 
+async def _get_joke_or_none():
+    try:
+        return await get_joke()
+    except (httpx.HTTPError, ValueError, AttributeError) as e:
+        # сеть, битый JSON или неожиданная структура ответа
+        logging.error(f"Ошибка при получении шутки: {e}")
+        return None
+
+
+# Инлайн-запросы летят на каждую набранную букву: шутку с предсказанием держим
+# INLINE_EXTRAS_TTL секунд, а одновременные запросы ждут одну и ту же загрузку
+INLINE_EXTRAS_TTL = 30
+_inline_extras = (0.0, None)  # (когда протухает по loop.time(), (шутка, предсказание))
+_inline_extras_task: Optional[asyncio.Task] = None
+
+
+async def _fetch_inline_extras():
+    # Оба внешних сайта опрашиваем одновременно: ждём самый медленный, а не сумму
+    # (get_cookies сама ловит сетевые ошибки и отдаёт заглушку)
+    return await asyncio.gather(_get_joke_or_none(), get_cookies())
+
+
+def _store_inline_extras(task: asyncio.Task):
+    global _inline_extras, _inline_extras_task
+    _inline_extras_task = None
+    if task.cancelled() or task.exception() is not None:
+        return
+    extras = tuple(task.result())
+    # Неудачные загрузки не запоминаем — следующий запрос попробует снова
+    joke_text, prediction = extras
+    if joke_text is not None and prediction != COOKIES_UNAVAILABLE:
+        _inline_extras = (task.get_loop().time() + INLINE_EXTRAS_TTL, extras)
+
+
+async def get_inline_extras():
+    global _inline_extras_task
+    expires_at, extras = _inline_extras
+    if extras is not None and asyncio.get_running_loop().time() < expires_at:
+        return extras
+    if _inline_extras_task is None:
+        _inline_extras_task = asyncio.create_task(_fetch_inline_extras())
+        _inline_extras_task.add_done_callback(_store_inline_extras)
+    # shield: отмена одного инлайн-запроса не должна обрывать загрузку для остальных
+    return await asyncio.shield(_inline_extras_task)
+
+
+# Карточка "праздников нет" одинакова для всех — собираем её один раз
+_NO_HOLIDAY_ARTICLE = InlineQueryResultArticle(
+    id="no_holiday",
+    title="📅 Праздников сегодня нет",
+    description="Обычный рабочий день...",
+    input_message_content=InputTextMessageContent(
+        message_text="Сегодня нет праздников, но я всё равно желаю тебе хорошего дня!")
+)
+
+
 @dp.inline_query()
 async def inline_handler(query: types.InlineQuery):
     user_name = query.from_user.first_name or "Друг"
@@ -494,6 +1077,8 @@ async def inline_handler(query: types.InlineQuery):
     holiday_text = get_today_holiday()
     results = []
 
+    joke_text, prediction = await get_inline_extras()
+
     # 1. Цитата
     results.append(
         InlineQueryResultArticle(
@@ -514,19 +1099,10 @@ async def inline_handler(query: types.InlineQuery):
             )
         )
     else:
-        results.append(
-            InlineQueryResultArticle(
-                id="no_holiday",
-                title="📅 Праздников сегодня нет",
-                description="Обычный рабочий день...",
-                input_message_content=InputTextMessageContent(
-                    message_text="Сегодня нет праздников, но я всё равно желаю тебе хорошего дня!")
-            )
-        )
+        results.append(_NO_HOLIDAY_ARTICLE)
 
     # 3. Шутка
-    try:
-        joke_text = get_joke()
+    if joke_text is not None:
         results.append(
             InlineQueryResultArticle(
                 id=f"joke",
@@ -536,23 +1112,17 @@ async def inline_handler(query: types.InlineQuery):
                 )
             )
         )
-    except Exception as e:
-        logging.error(f"Ошибка при получении шутки: {e}")
 
     # 4. Предсказание
-    try:
-        prediction = get_cookies()
-        results.append(
-            InlineQueryResultArticle(
-                id=f"cookies",
-                title="🥠 Печенье с предсказанием",
-                input_message_content=InputTextMessageContent(
-                    message_text=f"🥠 {prediction}"
-                )
+    results.append(
+        InlineQueryResultArticle(
+            id=f"cookies",
+            title="🥠 Печенье с предсказанием",
+            input_message_content=InputTextMessageContent(
+                message_text=f"🥠 {prediction}"
             )
         )
-    except Exception as e:
-        logging.error(f"Ошибка при получении {e}")
+    )
 
     results.append(
         InlineQueryResultArticle(
@@ -564,29 +1134,46 @@ async def inline_handler(query: types.InlineQuery):
     await query.answer(results, cache_time=1)
 
 # --- ХЭНДЛЕРЫ КОМАНД ---
-@dp.message(F.text.lower().contains("братан, выдай цитату"))
+# Триггеры-подстроки: один проход скомпилированного регэкспа с IGNORECASE
+# вместо отдельного .lower() всего сообщения в каждом фильтре
+_QUOTE_TRIGGER_RE = re.compile(r'братан, выдай цитату', re.IGNORECASE)
+# "братан" и "шанс"/"вероятность" в любом порядке — оба условия в одном фильтре
+_CHANCE_TRIGGER_RE = re.compile(r'(?=.*братан)(?=.*(?:шанс|вероятность))', re.IGNORECASE | re.DOTALL)
+_INSULT_TRIGGER_RE = re.compile(r'пидор', re.IGNORECASE)
+# "братан, выбери ..." — варианты забираем прямо из группы совпадения
+_CHOOSE_RE = re.compile(r'братан, выбери(?P<options>.*)', re.IGNORECASE | re.DOTALL)
+_OR_RE = re.compile(r' или ', re.IGNORECASE)
+
+
+def text_startswith(*prefixes: str):
+    """Фильтр по началу сообщения: приводим к нижнему регистру только срез длиной с префикс."""
+    prefixes = tuple(p.lower() for p in prefixes)
+    size = max(map(len, prefixes))
+    return F.text.func(lambda text: text[:size].lower().startswith(prefixes))
+
+
+@dp.message(F.text.regexp(_QUOTE_TRIGGER_RE, mode="search"))
 async def quote_handler(message: types.Message):
     await message.answer(f"📜 {get_random_quote()}")
 
 
-@dp.message(F.text.lower().startswith("братан, выбери"))
-async def choose_handler(message: types.Message):
-    content = message.text[12:].lower()
-    if " или " in content:
-        options = [opt.strip() for opt in content.split(" или ") if opt.strip()]
-        await message.answer(f"🎲 Мой выбор: **{random.choice(options)}**")
+@dp.message(F.text.regexp(_CHOOSE_RE).as_("choose"))
+async def choose_handler(message: types.Message, choose: re.Match):
+    parts = _OR_RE.split(choose["options"])
+    options = [opt.strip() for opt in parts if opt.strip()]
+    if len(parts) > 1 and options:
+        await message.answer(f"🎲 Мой выбор: **{rng.choice(options)}**")
     else:
         await message.answer("Используй 'или'. Пример: братан, выбери А или Б")
 
 
-@dp.message(F.text.lower().contains("шанс") | F.text.lower().contains("вероятность"))
+@dp.message(F.text.regexp(_CHANCE_TRIGGER_RE))
 async def chance_handler(message: types.Message):
-    if "братан" in message.text.lower():
-        percent = random.randint(0, 100)
-        await message.answer(f"🔮 Вероятность: **{percent}%**")
+    percent = rng.randint(0, 100)
+    await message.answer(f"🔮 Вероятность: **{percent}%**")
 
 
-@dp.message(F.text.lower().contains("пидор"))
+@dp.message(F.text.regexp(_INSULT_TRIGGER_RE, mode="search"))
 async def insult_handler(message: types.Message):
     user_name = (message.from_user.first_name if message.from_user else "Друг")
     await message.answer(f"Пидор - {user_name}!", reply_to_message_id=message.message_id)
@@ -610,73 +1197,75 @@ async def cmd_hi(message: types.Message):
         await message.answer(f"Привет! Я работаю в группе: {message.chat.title} id чата {message.chat.id}")
 
 
+# Текст меню не меняется — собираем его один раз, в хэндлере подставляем только имя
+MENU_TEXT = (
+    "🤖 **1. ОБЩЕНИЕ СО МНОЙ**\n"
+    "— В личке пиши что хочешь — отвечу всегда.\n"
+    "— В группах зови по имени: **«Митя, [твой вопрос]»**.\n"
+    "— Могу сам вклиниться в диалог (настраивается в `/settings`).\n\n"
+
+    "🎭 **2. КРЕАТИВ И РАЗВЛЕЧЕНИЯ**\n"
+    "— `Mit a [тема]` — сочный анекдот на заданную тему.\n"
+    "— `Mit t [начало]` — продолжу твою фразу в живом стиле.\n"
+    "— `братан, выдай цитату` — случайная цитата 📜.\n"
+    "— `братан, выбери А или Б` — сделаю выбор за тебя 🎲.\n"
+    "— `братан, шанс ...` — посчитаю вероятность 🔮.\n"
+    "— Отправь голосовое 🎤 — я всё услышу и отвечу (можно голосом!).\n\n"
+
+    "🖼 **3. СТИКЕРЫ И РЕАКЦИИ**\n"
+    "— Запоминаю ваши стикеры и кидаю их в тему.\n"
+    "— Ставлю реакции на сообщения — смотрю, что ты пишешь.\n\n"
+
+    "📈 **4. КАРМА И РЕПУТАЦИЯ**\n"
+    "— `/karma` — узнай, кто ты: Авторитет или Чушпан.\n"
+    "— Вежливость повышает карму, хамство — снижает.\n"
+    "— Токсичные сообщения = я гноблю, ровные = мы кореша.\n\n"
+
+    "⚙️ **5. НАСТРОЙКИ И ИНЛАЙН‑ЗАПРОСЫ**\n"
+    "— `/settings` — настрой мои «мозги»: шанс ответа, ИИ, голос, авто‑вмешательство.\n"
+    "— `@Твой_Юзернейм_Бота` — инлайн‑меню с:\n"
+    "   • 📜 Цитатами\n"
+    "   • 🥳 Праздниками\n"
+    "   • 🤡 Шутками\n"
+    "   • 🥠 Печеньем с предсказанием\n"
+    "   • 👋 Приветствием\n\n"
+
+    "☝️ **ВАЖНО**\n"
+    "— Я запоминаю последние 20 сообщений — не делай вид, что мы не знакомы.\n"
+    "— Общайся красиво — и всё будет ровно.\n"
+    "— Чем ты вежливее — тем я добрее 😉"
+)
+
+
 @dp.message(Command("menu"))
 async def cmd_menu(message: types.Message):
     user_name = message.from_user.first_name if message.from_user else "Друг"
-    menu_text = (
+    await message.answer(
         f"👋 Здарова, {user_name}! Я Митя — твой ровный ИИ‑соавтор. Вот чё я умею — читай внимательно, чтоб потом не переспрашивать:\n\n"
-
-
-        "🤖 **1. ОБЩЕНИЕ СО МНОЙ**\n"
-        "— В личке пиши что хочешь — отвечу всегда.\n"
-        "— В группах зови по имени: **«Митя, [твой вопрос]»**.\n"
-        "— Могу сам вклиниться в диалог (настраивается в `/settings`).\n\n"
-
-        "🎭 **2. КРЕАТИВ И РАЗВЛЕЧЕНИЯ**\n"
-        "— `Mit a [тема]` — сочный анекдот на заданную тему.\n"
-        "— `Mit t [начало]` — продолжу твою фразу в живом стиле.\n"
-        "— `братан, выдай цитату` — случайная цитата 📜.\n"
-        "— `братан, выбери А или Б` — сделаю выбор за тебя 🎲.\n"
-        "— `братан, шанс ...` — посчитаю вероятность 🔮.\n"
-        "— Отправь голосовое 🎤 — я всё услышу и отвечу (можно голосом!).\n\n"
-
-        "🖼 **3. СТИКЕРЫ И РЕАКЦИИ**\n"
-        "— Запоминаю ваши стикеры и кидаю их в тему.\n"
-        "— Ставлю реакции на сообщения — смотрю, что ты пишешь.\n\n"
-
-        "📈 **4. КАРМА И РЕПУТАЦИЯ**\n"
-        "— `/karma` — узнай, кто ты: Авторитет или Чушпан.\n"
-        "— Вежливость повышает карму, хамство — снижает.\n"
-        "— Токсичные сообщения = я гноблю, ровные = мы кореша.\n\n"
-
-        "⚙️ **5. НАСТРОЙКИ И ИНЛАЙН‑ЗАПРОСЫ**\n"
-        "— `/settings` — настрой мои «мозги»: шанс ответа, ИИ, голос, авто‑вмешательство.\n"
-        "— `@Твой_Юзернейм_Бота` — инлайн‑меню с:\n"
-        "   • 📜 Цитатами\n"
-        "   • 🥳 Праздниками\n"
-        "   • 🤡 Шутками\n"
-        "   • 🥠 Печеньем с предсказанием\n"
-        "   • 👋 Приветствием\n\n"
-
-        "☝️ **ВАЖНО**\n"
-        "— Я запоминаю последние 20 сообщений — не делай вид, что мы не знакомы.\n"
-        "— Общайся красиво — и всё будет ровно.\n"
-        "— Чем ты вежливее — тем я добрее 😉"
+        + MENU_TEXT,
+        parse_mode="Markdown"
     )
 
-    await message.answer(menu_text, parse_mode="Markdown")
+
+RANK_LEVELS = [
+    (120, "💎 Легенда двора"),
+    (100, "👑 Авторитет"),
+    (80, "🤝 Старший кореш"),
+    (60, "🤝 Ровный тип"),
+    (40, "🙂 Уважаемый"),
+    (10, "👤 Свой пацан"),
+    (-5, "👤 Прохожий"),
+    (-10, "⚠️ Мутный тип"),
+    (-40, "⚠️ Неприятный"),
+    (-60, "❌ Чушпан"),
+    (-80, "🔥 Конфликтный"),
+    (-100, "☠️ Проблемный")
+]
+_RANK_INDEX = _threshold_index(RANK_LEVELS)
 
 
 def get_rank_name(rep):
-    levels = [
-        (120, "💎 Легенда двора"),
-        (100, "👑 Авторитет"),
-        (80, "🤝 Старший кореш"),
-        (60, "🤝 Ровный тип"),
-        (40, "🙂 Уважаемый"),
-        (10, "👤 Свой пацан"),
-        (-5, "👤 Прохожий"),
-        (-10, "⚠️ Мутный тип"),
-        (-40, "⚠️ Неприятный"),
-        (-60, "❌ Чушпан"),
-        (-80, "🔥 Конфликтный"),
-        (-100, "☠️ Проблемный")
-    ]
-
-    for threshold, title in levels:
-        if rep >= threshold:
-            return title
-    return "💀 Черт закатанный"
+    return pick_by_threshold(_RANK_INDEX, rep, "💀 Черт закатанный")
 
 
 @dp.message(Command("karma"))
@@ -758,35 +1347,81 @@ async def settings_chance(callback: CallbackQuery):
         logging.exception("Ошибка обработки chance settings")
 
 
-@dp.message(F.sticker)
-async def catch_stickers_handler(message: types.Message):
-    if message.from_user.id == bot.id:
-        return
+# Настроение популярных эмодзи знаем и так; LLM спрашиваем только про незнакомые,
+# а её ответ запоминаем навсегда — эмодзи своего смысла не меняют
+_EMOJI_SENTIMENT = {
+    **dict.fromkeys(
+        "❤🧡💛💚💙💜🖤🤍💖💗💓💞💕😍🥰😘😻🤩😎🥳🎉✨🌟⭐🔥💯👍👏🙌💪🤝🙏"
+        "😂🤣😁😄😃😀😊☺🙂😇🤗🥹👑🏆💎🍾🥂🎊💐🌹🌸😋😜😝😛🤑🫶",
+        "positive"
+    ),
+    **dict.fromkeys(
+        "😡🤬😠👎🖕💩🤮🤢🤡😤😒🙄😑🐍🗑🚮💀☠👿😈🤦🥴😾🙅⛔❌🤥😬",
+        "toxic"
+    ),
+    **dict.fromkeys(
+        "😐😶🤔🧐🤷👀👌🤙✌😮😯😲😳🥺😢😭😔😞😴🥱🤨🫠🙃😏",
+        "neutral"
+    ),
+}
+# Уже разобранные стикеры (по file_unique_id): повторный стикер не трогает ни LLM, ни БД
+SEEN_STICKERS_MAX = 10000
+_seen_stickers = set()
 
-    f_id = message.sticker.file_id
-    emoji = message.sticker.emoji or "❓"
 
-    # Быстрая оценка контекста (чтобы не гонять LLM на каждый чих)
-    # Если хочешь идеальной точности, можно вызвать тут check_toxicity_llm(emoji)
-    score = await check_toxicity_llm(f"Стикер с эмодзи: {emoji}")
+async def get_emoji_sentiment(emoji: str) -> str:
+    key = emoji.replace("\ufe0f", "")  # ❤️ и ❤ — одно и то же
+    sentiment = _EMOJI_SENTIMENT.get(key)
+    if sentiment is not None:
+        return sentiment
 
+    prompt_text = f"Стикер с эмодзи: {emoji}"
+    score = await check_toxicity_llm(prompt_text)
     if score >= 1:
         sentiment = "positive"
     elif score <= -1:
         sentiment = "toxic"
     else:
         sentiment = "neutral"
+    # Запоминаем, только если оценку дала модель (она попала в _toxicity_cache),
+    # а не заглушка 0 после ошибки Ollama — иначе эмодзи навсегда останется "neutral"
+    if _toxicity_key(prompt_text) in _toxicity_cache:
+        _EMOJI_SENTIMENT[key] = sentiment
+    return sentiment
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+
+@dp.message(F.sticker)
+async def catch_stickers_handler(message: types.Message):
+    if message.from_user.id == bot.id:
+        return
+
+    unique_id = message.sticker.file_unique_id
+    if unique_id in _seen_stickers:
+        return
+
+    f_id = message.sticker.file_id
+    emoji = message.sticker.emoji or "❓"
+
+    sentiment = await get_emoji_sentiment(emoji)
+
+    db = get_db()
+    async with _db_write_lock:
+        cursor = await db.execute(
             "INSERT OR IGNORE INTO collected_stickers (file_id, emoji, sentiment) VALUES (?, ?, ?)",
             (f_id, emoji, sentiment)
         )
         await db.commit()
+    if cursor.rowcount:
+        remember_sticker(f_id, sentiment)
+
+    # Разобранным считаем только после удачной записи: при ошибке стикер соберём в следующий раз
+    if len(_seen_stickers) >= SEEN_STICKERS_MAX:
+        _seen_stickers.clear()
+    _seen_stickers.add(unique_id)
 
 
 # --- КОМАНДА: Mit a (Анекдот) ---
-@dp.message(F.text.lower().startswith("mit a") | F.text.lower().startswith("мит а"))
+@dp.message(text_startswith("mit a", "мит а"))
 async def mitya_joke_handler(message: types.Message):
     # Отрезаем "мит а " (5 символов)
     user_input = message.text[5:].strip()
@@ -809,7 +1444,7 @@ async def mitya_joke_handler(message: types.Message):
 
 
 # --- КОМАНДА: Mit t (Продолжи фразу) ---
-@dp.message(F.text.lower().startswith("mit t") | F.text.lower().startswith("мит т"))
+@dp.message(text_startswith("mit t", "мит т"))
 async def mitya_continue_handler(message: types.Message):
     # Вырезаем префикс "mit t " аккуратно
     start_text = message.text[5:].lstrip()
@@ -834,25 +1469,46 @@ async def mitya_continue_handler(message: types.Message):
     await message.answer(f"{continuation}")
 
 # --- КОМАНДА: Mit s (Случайный стикер) ---
-@dp.message(F.text.lower().startswith("mit s") | F.text.lower().startswith("мит c"))
+@dp.message(text_startswith("mit s", "мит c"))
 async def mitya_random_sticker_handler(message: types.Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Выбираем один случайный file_id из всей таблицы
-        cursor = await db.execute(
-            "SELECT file_id FROM collected_stickers ORDER BY RANDOM() LIMIT 1"
-        )
-        row = await cursor.fetchone()
+    # Выбираем один случайный file_id из всей таблицы
+    sticker_id = get_random_sticker()
 
-        if row:
-            sticker_id = row[0]
-            # Отправляем стикер как ответ на команду
-            await message.answer_sticker(sticker=sticker_id)
-        else:
-            # Если база еще пустая, Митя ответит по-пацански
-            await message.reply("Пусто в закромах, еще ни одного стикера не подрезал.")
+    if sticker_id:
+        # Отправляем стикер как ответ на команду
+        await message.answer_sticker(sticker=sticker_id)
+    else:
+        # Если база еще пустая, Митя ответит по-пацански
+        await message.reply("Пусто в закромах, еще ни одного стикера не подрезал.")
 
 # --- КОМАНДА: Mit i (Пробить инфу) ---
-@dp.message(F.text.lower().startswith("mit i") | F.text.lower().startswith("мит и"))
+# Готовые пересказы по запросу: повторный "mit i" не ходит ни в поиск, ни в Ollama.
+# Инфа в инете меняется, поэтому держим не дольше часа
+INFO_CACHE_SIZE = 256
+INFO_CACHE_TTL = 3600
+_info_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+def get_cached_info(query: str) -> Optional[str]:
+    entry = _info_cache.get(query)
+    if entry is None:
+        return None
+    expires_at, text = entry
+    if asyncio.get_running_loop().time() >= expires_at:
+        del _info_cache[query]
+        return None
+    _info_cache.move_to_end(query)
+    return text
+
+
+def cache_info(query: str, text: str):
+    _info_cache[query] = (asyncio.get_running_loop().time() + INFO_CACHE_TTL, text)
+    _info_cache.move_to_end(query)
+    if len(_info_cache) > INFO_CACHE_SIZE:
+        _info_cache.popitem(last=False)
+
+
+@dp.message(text_startswith("mit i", "мит и"))
 async def mitya_web_search_handler(message: types.Message):
     # Извлекаем сам запрос
     if message.text.lower().startswith("митя, пробни"):
@@ -863,6 +1519,11 @@ async def mitya_web_search_handler(message: types.Message):
     if not query:
         return await message.reply("А че пробивать-то? Пиши запрос после команды, не тупи.")
 
+    cache_key = query.lower()
+    cached = get_cached_info(cache_key)
+    if cached is not None:
+        return await message.reply(f"🔍 **Mit Info докладывает:**\n\n{cached}")
+
     await bot.send_chat_action(message.chat.id, "typing")
 
     # 1. Лезем в инет
@@ -880,13 +1541,16 @@ async def mitya_web_search_handler(message: types.Message):
     prompt = f"Вот инфа из поиска: {raw_info}\n\nПоясни за это: {query}"
 
     mitya_explanation = await ask_mitya_special(prompt, sys_instr)
+    if mitya_explanation != SPECIAL_AI_FALLBACK:
+        cache_info(cache_key, mitya_explanation)
 
     await message.reply(f"🔍 **Mit Info докладывает:**\n\n{mitya_explanation}")
 
 # --- ГОЛОСОВЫЕ ---
 @dp.message(F.voice)
 async def handle_voice(message: types.Message):
-    if whisper_model is None:
+    # Распознаёт batched_whisper — без него не качаем и не ставим аудио в очередь
+    if batched_whisper is None:
         logging.warning("Whisper model not loaded")
         return await message.reply("Голосовой модуль недоступен.")
 
@@ -894,64 +1558,105 @@ async def handle_voice(message: types.Message):
     if message.voice.duration > 60:
         return await message.reply("Слышь, я такие длинные телеги не слушаю. Давай короче, до минуты!")
 
-    s = await get_chat_settings(message.chat.id)
+    s = _settings_cache.get(message.chat.id) or await get_chat_settings(message.chat.id)
     if not s['voice_enabled']:
         return
 
     await bot.send_chat_action(chat_id=message.chat.id, action="upload_voice")
-    file = await bot.get_file(message.voice.file_id)
-
-    tf = tempfile.NamedTemporaryFile(suffix=".ogg", delete=False)
-    path = tf.name
-    tf.close()
 
     try:
-        await bot.download_file(file.file_path, path)
-        # Faster-Whisper возвращает 
-        if whisper_model is None:
-            logging.warning("Whisper model not loaded")
-            await message.reply("Голосовой модуль недоступен.")
-        else:
-            segments, info = await asyncio.to_thread(whisper_model.transcribe, path, beam_size=1, language="ru")
-
-        raw_text = " ".join([s.text for s in segments]).strip()
+        # file_unique_id одинаков у всех пересылок одного и того же голосового
+        file_key = message.voice.file_unique_id
+        raw_text = get_cached_transcript(file_key)
+        if raw_text is None:
+            # Качаем сразу в память (BytesIO) — Faster-Whisper декодирует его через PyAV без диска
+            audio = await bot.download(message.voice)
+            raw_text = await transcribe_voice(audio)
+            cache_transcript(file_key, raw_text)
 
         if not raw_text:
             return await message.answer("Тишина в эфире...")
 
-        # Анализ через новую функцию
-        score = await check_toxicity_llm(raw_text)
+        user_id, name, is_bot, username = extract_sender_info(message)
+
+        # Анализ токсичности и ответ ИИ независимы — гоняем их параллельно
+        reply = None
+        if _MITYA_MENTION_RE.search(raw_text):
+            clean_text = _MITYA_MENTION_RE.sub("", raw_text).strip()
+            score, reply = await asyncio.gather(
+                check_toxicity_llm(raw_text),
+                ask_mitya_ai(message.chat.id, clean_text, user_id)
+            )
+        else:
+            score = await check_toxicity_llm(raw_text)
 
         # Обновление репутации за голос
-        user_id, name, is_bot, username = extract_sender_info(message)
         if not is_bot and score != 0:
-            await update_reputation(message.chat.id, user_id, name, score)
-            
-            
+            update_reputation(message.chat.id, user_id, name, score)
 
-        if "митя" in raw_text.lower():
-            clean_text = raw_text.lower().replace("митя", "").strip()
-            reply = await ask_mitya_ai(message.chat.id, clean_text, user_id)
+        if reply is not None:
             logging.info(f"DEBUG: voice reply={reply!r} for user_id={user_id}")
             await message.reply(f"🎤 Расшифровка: {raw_text}\n\n😎 Митя: {reply}")
         else:
             await message.reply(f"🎤 Расшифровка: {raw_text}")
     except Exception:
         logging.exception("Voice Error")
-    finally:
-        if os.path.exists(path):
-            os.remove(path)
 
 
 # --- ТЕКСТ ---
+# Ссылки на фоновые задачи: иначе сборщик мусора может прибить их на полпути
+_background_tasks = set()
+
+
+def fire_and_forget(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+REACTION_CHANCE = 0.20
+STICKER_CHANCE = 0.21
+
+# Реакции по настроению — кортежи создаются один раз при импорте
+EMOJI_MAP = {
+    "positive": (
+        "🔥", "👍", "🚀", "💥", "💪", "👑", "😎", "🥳", "✨", "🌟", "❤️",
+        "👍", "🙌", "🔥🔥", "💯", "😍", "🤩", "👏", "🤑", "🎉"
+    ),
+    "toxic": (
+        "👎", "🤡", "🤨", "🖕", "😒", "🤬", "🤮", "💩", "🗑️", "😤",
+        "🤡🤡", "🙄", "😑", "🤦‍♂️", "🤦", "🐍", "🤢", "🚮", "😡"
+    ),
+    "neutral": (
+        "👀", "🤝", "😐", "🤔", "👌", "🔍", "📊", "💭", "🧐", "🤷",
+        "👁️", "🕵️", "⚖️", "🟡", "🤙", "✌️", "🧘", "🔎", "📝"
+    ),
+}
+
+
+async def _react_quietly(message: types.Message, emoji: str):
+    try:
+        await message.react([types.ReactionTypeEmoji(emoji=emoji)])
+    except Exception:
+        pass
+
+
+async def _reply_sticker_quietly(message: types.Message, sticker: str):
+    try:
+        await message.reply_sticker(sticker=sticker)
+    except Exception as e:
+        logging.error(f"Ошибка при выдаче стикера: {e}")
+
+
 @dp.message(F.text)
 async def smart_text_handler(message: types.Message):
-    logging.info("HANDLER TRIGGERED")
+    logging.debug("HANDLER TRIGGERED")
     chat_id = message.chat.id
     is_forward = bool(message.forward_from or message.forward_from_chat)
 
     raw_text = message.text or ""
-    text_lower = raw_text.lower() # Исправлено имя переменной для консистентности
+    mentions_mitya = _MITYA_MENTION_RE.search(raw_text) is not None
 
     user_id, name, is_bot, username = extract_sender_info(message)
     is_private = message.chat.type == "private"
@@ -962,112 +1667,110 @@ async def smart_text_handler(message: types.Message):
             message.reply_to_message.from_user.id == bot.id
     )
 
+    # Кубики на реакцию и стикер бросаем сразу: от них зависит, нужна ли оценка вообще
+    # random() — один вызов C без целочисленной арифметики randint; шансы те же: 20% и 21%
+    wants_reaction = rng.random() < REACTION_CHANCE
+    wants_sticker = rng.random() < STICKER_CHANCE
+    counts_karma = not is_bot and not is_forward
+
+    # Оценку токсичности запускаем первой, но только если её кто-то использует:
+    # пересланное или сообщение бота без реакции и стикера в Ollama не гоняем
+    toxicity_task = None
+    if counts_karma or wants_reaction or wants_sticker:
+        toxicity_task = asyncio.create_task(check_toxicity_llm(raw_text))
+
+    # Настройки почти всегда уже в кэше — берём их без единого await
+    s = _settings_cache.get(chat_id) or await get_chat_settings(chat_id)
+
+    # 0. Решаем заранее, будет ли ответ ИИ, и запускаем его параллельно с оценкой
+    # токсичности — оба запроса идут в Ollama и друг от друга не зависят
+    ai_task = None
+    live = None
+    ai_started = asyncio.get_running_loop().time()
+    if s['ai_enabled']:
+        # А. Логика для лички
+        if is_private:
+            live = LiveReply(message)
+            ai_task = asyncio.create_task(
+                ask_mitya_ai(chat_id, raw_text, user_id=user_id, on_update=live.update)
+            )
+
+        # Б. Логика для групп (обращение или реплай)
+        elif mentions_mitya or is_reply_to_me:
+            clean_prompt = raw_text
+            if mentions_mitya:
+                # Используем регулярку, чтобы убрать только слово "митя"
+                clean_prompt = _MITYA_RE.sub('', raw_text).strip()
+                if not clean_prompt: clean_prompt = "Ау"
+
+            reply_to_context = message.reply_to_message.text if is_reply_to_me else None
+            live = LiveReply(message)
+            ai_task = asyncio.create_task(ask_mitya_ai(
+                chat_id,
+                clean_prompt,
+                user_id=user_id,
+                user_name=name,
+                reply_to_text=reply_to_context,
+                on_update=live.update
+            ))
+
+        # В. Случайное вклинивание
+        elif s['reply_chance'] > 0 and rng.random() * 100 < s['reply_chance']:
+            live = LiveReply(message, as_reply=False)
+            ai_task = asyncio.create_task(
+                ask_mitya_ai(chat_id, raw_text, user_id=user_id, user_name=name, is_auto=True,
+                             on_update=live.update)
+            )
+
     # 1. Оценка токсичности
-    score = await check_toxicity_llm(raw_text)
+    score = await toxicity_task if toxicity_task is not None else 0
     sentiment = "neutral"
     if score > 0:
         sentiment = "positive"
     elif score < 0:
         sentiment = "toxic"
 
-    # 2. Обновление кармы
-    if not is_bot and not is_forward:
-        #should_check_karma = is_private or ("митя" in text_lower) or is_reply_to_me
-        #if should_check_karma and score != 0:
-        if score != 0:
-            await update_reputation(chat_id, user_id, name, score)
-
-    s = await get_chat_settings(chat_id)
-
-
+    # Реакция и стикер — в фоне: ни карма, ни ответ ИИ их не ждут
     # --- БЛОК 1: РЕАКЦИИ (Независимо) ---
-    rand_val = random.randint(1, 100)
-    if rand_val <= 20:
-        EMOJI_MAP =  {
-    "positive": [
-        "🔥", "👍", "🚀", "💥", "💪", "👑", "😎", "🥳", "✨", "🌟", "❤️",
-        "👍", "🙌", "🔥🔥", "💯", "😍", "🤩", "👏", "🤑", "🎉"
-    ],
-    "toxic": [
-        "👎", "🤡", "🤨", "🖕", "😒", "🤬", "🤮", "💩", "🗑️", "😤",
-        "🤡🤡", "🙄", "😑", "🤦‍♂️", "🤦", "🐍", "🤢", "🚮", "😡"
-    ],
-    "neutral": [
-        "👀", "🤝", "😐", "🤔", "👌", "🔍", "📊", "💭", "🧐", "🤷",
-         "👁️", "🕵️", "⚖️", "🟡", "🤙", "✌️", "🧘", "🔎", "📝"
-    ]
-}
-        try:
-            emo = random.choice(EMOJI_MAP.get(sentiment, ["👀"]))
-            await message.react([types.ReactionTypeEmoji(emoji=emo)])
-        except Exception:
-            pass
+    if wants_reaction:
+        emo = rng.choice(EMOJI_MAP.get(sentiment, ("👀",)))
+        fire_and_forget(_react_quietly(message, emo))
 
     # --- БЛОК 2: СТИКЕРЫ (Независимо) ---
-    rand_val = random.randint(1, 100)
-    if 35 <= rand_val <= 55:
-        try:
-            async with aiosqlite.connect(DB_PATH) as db:
-                # Выбираем случайный стикер по нужному настроению
-                cursor = await db.execute(
-                    "SELECT file_id FROM collected_stickers WHERE sentiment = ? ORDER BY RANDOM() LIMIT 1",
-                    (sentiment,)
-                )
-                row = await cursor.fetchone()
+    if wants_sticker:
+        # Выбираем случайный стикер по нужному настроению
+        sticker_to_send = get_random_sticker(sentiment)
 
-                if row:
-                    sticker_to_send = row[0]
-                    await message.reply_sticker(sticker=sticker_to_send)
-                else:
-                    # Фоллбэк (если база еще пустая)
-                    backup = STICKERS_POSITIVE if sentiment == "positive" else STICKERS_TOXIC
-                    await message.reply_sticker(sticker=random.choice(backup))
-        except Exception as e:
-            logging.error(f"Ошибка при выдаче стикера из БД: {e}")
+        # Стикеров такого настроения ещё не собрали — просто молчим
+        if sticker_to_send:
+            fire_and_forget(_reply_sticker_quietly(message, sticker_to_send))
+
+    # 2. Обновление кармы
+    if counts_karma:
+        #should_check_karma = is_private or mentions_mitya or is_reply_to_me
+        #if should_check_karma and score != 0:
+        if score != 0:
+            update_reputation(chat_id, user_id, name, score)
 
     # --- БЛОК 3: ТЕКСТОВЫЙ ОТВЕТ ИИ (Теперь вне условий стикеров!) ---
-    if not s['ai_enabled']:
+    if ai_task is None:
         return
 
-    reply_text = None
-    is_auto = False
-
-    # А. Логика для лички
-    if is_private:
-        reply_text = await ask_mitya_ai(chat_id, raw_text, user_id=user_id)
-
-    # Б. Логика для групп (обращение или реплай)
-    elif "митя" in text_lower or is_reply_to_me:
-        clean_prompt = raw_text
-        if "митя" in text_lower:
-            # Используем регулярку, чтобы убрать только слово "митя"
-            clean_prompt = re.sub(r'\bмитя\b', '', raw_text, flags=re.IGNORECASE).strip()
-            if not clean_prompt: clean_prompt = "Ау"
-
-        reply_to_context = message.reply_to_message.text if is_reply_to_me else None
-        reply_text = await ask_mitya_ai(
-            chat_id,
-            clean_prompt,
-            user_id=user_id,
-            user_name=name,
-            reply_to_text=reply_to_context
-        )
-
-    # В. Случайное вклинивание
-    elif s['reply_chance'] > 0 and random.randint(1, 100) <= s['reply_chance']:
-        is_auto = True
-        reply_text = await ask_mitya_ai(chat_id, raw_text, user_id=user_id, user_name=name, is_auto=True)
+    reply_text = await ai_task
 
     # ОТПРАВКА ТЕКСТА
     if reply_text:
         try:
-            await bot.send_chat_action(chat_id=chat_id, action="typing")
-            await asyncio.sleep(random.uniform(0.5, 1.5))
+            # Если ответ уже пошёл стримом — просто дописываем финальный текст
+            # Иначе выдерживаем "человеческую" паузу, но в неё засчитывается время генерации:
+            # если модель думала дольше паузы — отвечаем сразу
+            if live.sent is None:
+                pause = rng.uniform(0.5, 1.5) - (asyncio.get_running_loop().time() - ai_started)
+                if pause > 0:
+                    await bot.send_chat_action(chat_id=chat_id, action="typing")
+                    await asyncio.sleep(pause)
 
-            if is_auto:
-                await message.answer(reply_text)
-            else:
-                await message.reply(reply_text)
+            await live.finish(reply_text)
 
         except Exception as e:
             error_msg = str(e).lower()
@@ -1083,19 +1786,41 @@ async def smart_text_handler(message: types.Message):
 
 # --- ЗАПУСК ---
 async def main():
-    await init_db()
-    logging.info("Митя запущен!")
-    await bot.set_my_commands([
-        types.BotCommand(command="hi", description="Привет узнать id"),
-        types.BotCommand(command="start", description="Перезапустить"),
-        types.BotCommand(command="menu", description="Меню"),
-        types.BotCommand(command="settings", description="Настройки"),
-        types.BotCommand(command="karma", description="Репутация")
-    ])
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    await open_db()
+    if whisper_model is not None:
+        # В тот же единственный поток Whisper: голосовые встанут в очередь за прогревом
+        _whisper_pool.submit(_warm_up_whisper)
+    rep_task = asyncio.create_task(reputation_flusher())
+    try:
+        await init_db()
+        await load_sticker_cache()
+        logging.info("Митя запущен!")
+        await bot.set_my_commands([
+            types.BotCommand(command="hi", description="Привет узнать id"),
+            types.BotCommand(command="start", description="Перезапустить"),
+            types.BotCommand(command="menu", description="Меню"),
+            types.BotCommand(command="settings", description="Настройки"),
+            types.BotCommand(command="karma", description="Репутация")
+        ])
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        # Дописываем накопленную карму до закрытия базы
+        _rep_queue.put_nowait(None)
+        await rep_task
+        _whisper_pool.shutdown(wait=False, cancel_futures=True)
+        await _ollama.aclose()
+        await _ext_client.aclose()
+        await close_db()
 
 
 if __name__ == "__main__":
+    # uvloop — event loop на libuv, заметно быстрее стандартного (только Linux/macOS)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        logging.info("uvloop не найден, работаем на стандартном asyncio")
+
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):